@@ -1,13 +1,22 @@
 # bot2.py
 import os
+import random
+import sys
 import time
-import json
+import atexit
+import signal
+import threading
 import html
-import io
+import re
+import tempfile
 import urllib.parse
-from collections import deque
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
+import orjson
 import requests
+import websocket
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
@@ -20,7 +29,10 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID   = os.getenv("GROUP_CHAT_ID")
 POLL_INTERVAL      = int(os.getenv("POLL_INTERVAL", "30"))
 XRPL_RPC_URL       = os.getenv("XRPL_RPC_URL") or "https://s1.ripple.com:51234/"
+XRPL_WS_URL        = os.getenv("XRPL_WS_URL", "wss://s1.ripple.com/")  # empty disables the mint stream
 STATE_PATH         = os.getenv("STATE_PATH", "/mnt/data/state.json")
+# Public gateways raced for metadata fetches; the first one is also used to build ipfs:// links
+IPFS_GATEWAYS      = [g.strip() for g in (os.getenv("IPFS_GATEWAYS") or "https://ipfs.io/ipfs/,https://dweb.link/ipfs/").split(",") if g.strip()]
 
 if not (BITHOMP_API_TOKEN and XRPL_NFT_ISSUER and TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID):
     raise RuntimeError("Missing required env vars: BITHOMP_API_TOKEN, FUZZYBEAR_ISSUER_ADDRESS, TELEGRAM_BOT_TOKEN, GROUP_CHAT_ID")
@@ -30,37 +42,65 @@ if not (BITHOMP_API_TOKEN and XRPL_NFT_ISSUER and TELEGRAM_BOT_TOKEN and TELEGRA
 # ===============================
 BITHOMP_SALES_URL = "https://bithomp.com/api/v2/nft-sales"
 BITHOMP_NFT_URL   = "https://bithomp.com/api/v2/nft/{}"
+JSON_HEADERS      = {"Content-Type": "application/json"}  # for bodies pre-encoded with orjson.dumps
 
-def make_session():
+def make_session(headers=None, pool_connections=16, pool_maxsize=32, retries=6, backoff_factor=0.7,
+                 allowed_methods=("GET", "POST")):
     s = requests.Session()
     retry = Retry(
-        total=6,
-        connect=6,
-        read=6,
-        backoff_factor=0.7,
+        total=retries,
+        connect=retries,
+        read=retries,
+        backoff_factor=backoff_factor,
         status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=("GET", "POST"),
+        allowed_methods=allowed_methods,
         respect_retry_after_header=True,
     )
-    adapter = HTTPAdapter(max_retries=retry, pool_connections=16, pool_maxsize=32)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
     s.mount("https://", adapter)
     s.mount("http://", adapter)
-    s.headers.update({"x-bithomp-token": BITHOMP_API_TOKEN})
+    if headers:
+        s.headers.update(headers)
     return s
 
-SESSION = make_session()
+# Polled endpoints get a short retry budget: the next cycle is the natural retry, and a long
+# urllib3 backoff here would stall the whole poll loop
+SESSION = make_session({"x-bithomp-token": BITHOMP_API_TOKEN}, retries=2, backoff_factor=0.3)
+# Separate pool for api.telegram.org so the bot token host never sees the bithomp header.
+# It keeps the long retry budget, but only connection failures are retried: a replayed
+# sendMessage/sendPhoto can post twice, and 429s are left to the retry_after handling in send_telegram.
+TELEGRAM_SESSION = make_session(pool_connections=4, pool_maxsize=8, allowed_methods=("GET",))
+# Shared worker pool for per-event metadata fetches (kept alive across polls)
+FETCH_WORKERS = 8
+_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+# poll_sales and poll_mints run side by side each cycle; kept apart from _EXECUTOR so a poller
+# waiting on its own fetches can never starve them of workers
+_POLLERS = ThreadPoolExecutor(max_workers=2)
+# Gateway races get their own pool: they are submitted from inside _EXECUTOR tasks
+_GATEWAY_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_WORKERS * len(IPFS_GATEWAYS))
+GATEWAY_TIMEOUT = (3, 10)  # (connect, read) per gateway; a stalled gateway just loses the race
+
+# Metadata/image hosts (ipfs.io and friends) and the XRPL node get their own pools, also tokenless
+IPFS_SESSION = make_session(pool_connections=8, pool_maxsize=32)
+RPC_SESSION = make_session(pool_connections=2, pool_maxsize=4, retries=2, backoff_factor=0.3)
+# Gateway races retry once at most: a slow gateway should lose the race, not hold a
+# _GATEWAY_EXECUTOR worker through a long backoff chain while the next batch queues behind it
+GATEWAY_SESSION = make_session(pool_connections=len(IPFS_GATEWAYS) + 1,
+                               pool_maxsize=FETCH_WORKERS * len(IPFS_GATEWAYS),
+                               retries=1, backoff_factor=0.3)
 
 # ===============================
 # State (seen tx hashes, mints)
 # ===============================
 MAX_SEEN = 2000
+STATE_FLUSH_INTERVAL = 5  # seconds; state.json is rewritten at most this often
 
 def load_state():
     if not STATE_PATH:
         return {"seen_sales": [], "seen_mints": []}
     try:
-        with open(STATE_PATH, "r") as f:
-            return json.load(f)
+        with open(STATE_PATH, "rb") as f:
+            return orjson.loads(f.read())
     except Exception:
         return {"seen_sales": [], "seen_mints": []}
 
@@ -68,113 +108,322 @@ def save_state(state):
     if not STATE_PATH:
         return
     try:
-        os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-        with open(STATE_PATH, "w") as f:
-            json.dump(state, f)
+        state_dir = os.path.dirname(STATE_PATH)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        # Write a sibling temp file in one buffered write, then swap it in atomically
+        tmp_path = STATE_PATH + ".tmp"
+        data = orjson.dumps(state)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, STATE_PATH)
     except Exception as e:
         print(f"Warning: failed to persist state: {e}")
 
+_HEX = frozenset("0123456789abcdefABCDEF")
+SEEN_FORMAT = "fp64"  # persisted seen windows hold 16-hex-char fingerprints
+
+def _hash_key(tx_hash):
+    # XRPL tx hashes are 64 hex chars of SHA-512Half output, so their first 64 bits are already a
+    # uniform fingerprint: a small int key is about half the size of the 32 raw bytes, and a
+    # collision across the whole 2x2000 window is ~1e-13 likely (the cost would be one skipped post)
+    if len(tx_hash) == 64 and _HEX.issuperset(tx_hash):
+        return int(tx_hash[:16], 16)
+    return tx_hash  # not a tx hash; kept in memory only, never persisted
+
+def _load_seen(raw, fmt=None):
+    # fp64 blobs are 16-char chunks; older blobs hold full 64-char hashes, oldest files a list
+    try:
+        if isinstance(raw, str):
+            width = 16 if fmt == SEEN_FORMAT else 64
+            chunks = [raw[i:i + width] for i in range(0, len(raw), width)]
+        else:
+            chunks = list(raw or [])
+        chunks = chunks[-MAX_SEEN:]
+        if fmt == SEEN_FORMAT:
+            return OrderedDict.fromkeys(int(c, 16) for c in chunks)
+        return OrderedDict.fromkeys(_hash_key(h) for h in chunks)
+    except Exception as e:
+        # Same policy as load_state: a damaged window must not keep the bot from starting
+        print(f"Ignoring unreadable seen window in state ({e}); starting empty.")
+        return OrderedDict()
+
+def _dump_seen(seen):
+    return "".join(f"{k:016x}" for k in seen if isinstance(k, int))
+
 STATE = load_state()
-seen_sales = deque(STATE.get("seen_sales", []), maxlen=MAX_SEEN)
-seen_mints = deque(STATE.get("seen_mints", []), maxlen=MAX_SEEN)
-seen_sales_set = set(seen_sales)
-seen_mints_set = set(seen_mints)
+# OrderedDicts double as bounded LRU windows with O(1) membership
+seen_sales = _load_seen(STATE.get("seen_sales"), STATE.get("seen_format"))
+seen_mints = _load_seen(STATE.get("seen_mints"), STATE.get("seen_format"))
+STATE_DIRTY = False
+_LAST_FLUSH = 0.0
+
+def is_seen(seen, tx_hash, refresh=False):
+    """Membership test; refresh=True also marks the hash as recently used."""
+    key = _hash_key(tx_hash)
+    if key not in seen:
+        return False
+    if refresh:
+        seen.move_to_end(key)
+    return True
+
+def _remember(seen, tx_hash):
+    """Record tx_hash; True if it was not already in the window."""
+    if not tx_hash:
+        return False
+    key = _hash_key(tx_hash)
+    if key in seen:
+        seen.move_to_end(key)
+        return False
+    seen[key] = None
+    mark_state_dirty()
+    if len(seen) > MAX_SEEN:
+        seen.popitem(last=False)
+    return True
 
 def remember_sale(tx_hash):
-    if tx_hash not in seen_sales_set:
-        seen_sales.append(tx_hash)
-        seen_sales_set.add(tx_hash)
-        if len(seen_sales) > MAX_SEEN:
-            while len(seen_sales) > MAX_SEEN:
-                popped = seen_sales.popleft()
-                seen_sales_set.discard(popped)
+    return _remember(seen_sales, tx_hash)
 
 def remember_mint(tx_hash):
-    if tx_hash not in seen_mints_set:
-        seen_mints.append(tx_hash)
-        seen_mints_set.add(tx_hash)
-        if len(seen_mints) > MAX_SEEN:
-            while len(seen_mints) > MAX_SEEN:
-                popped = seen_mints.popleft()
-                seen_mints_set.discard(popped)
+    return _remember(seen_mints, tx_hash)
+
+def mark_state_dirty():
+    global STATE_DIRTY
+    STATE_DIRTY = True
 
 def persist_now():
-    STATE["seen_sales"] = list(seen_sales)
-    STATE["seen_mints"] = list(seen_mints)
+    global STATE_DIRTY, _LAST_FLUSH
+    STATE["seen_sales"] = _dump_seen(seen_sales)
+    STATE["seen_mints"] = _dump_seen(seen_mints)
+    STATE["seen_format"] = SEEN_FORMAT
+    STATE["sales_anchored"] = _SALES_ANCHORED
+    # Poll anchors ride along with every flush; they never mark the state dirty on their own
+    # because a stale anchor only widens the next scan, and the seen windows dedupe it
+    STATE["sales_etag"] = _SALES_ETAG
+    STATE["sales_last_modified"] = _SALES_LM
+    STATE["mint_ledger_cursor"] = _MINT_LEDGER_CURSOR
     save_state(STATE)
+    STATE_DIRTY = False
+    _LAST_FLUSH = time.monotonic()
+
+def maybe_flush_state():
+    if STATE_DIRTY and time.monotonic() - _LAST_FLUSH > STATE_FLUSH_INTERVAL:
+        persist_now()
 
 # ===============================
 # Helpers
 # ===============================
+_TS_FMT = "%Y-%m-%d %H:%M:%S"
+
+@lru_cache(maxsize=1024)
+def fmt_ts(ts: int) -> str:
+    return time.strftime(_TS_FMT, time.gmtime(ts))
+
 def abbr(text, length=5):
     if text and len(text) > length:
         return text[:length] + "..."
     return text or "N/A"
 
+# Characters quote(safe=":/?&=%") would rewrite; most on-ledger URIs contain none of them
+_NEEDS_QUOTE = re.compile(r"[^A-Za-z0-9:/?&=%._~-]")
+
+@lru_cache(maxsize=4096)
 def decode_uri(hex_uri: str):
     try:
         uri_bytes = bytes.fromhex(hex_uri)
         uri = uri_bytes.decode("utf-8", errors="ignore").strip("\x00")
     except Exception:
         return None
-    uri = urllib.parse.quote(uri, safe=":/?&=%")
+    if _NEEDS_QUOTE.search(uri):
+        uri = urllib.parse.quote(uri, safe=":/?&=%")
     if uri.startswith("ipfs://"):
         cid = uri[len("ipfs://"):]
-        return f"https://ipfs.io/ipfs/{cid}"
+        return IPFS_GATEWAYS[0] + cid
     return uri
 
+def gateway_urls(url: str):
+    """The same IPFS path on every configured gateway, or just [url] for non-gateway hosts."""
+    for gateway in IPFS_GATEWAYS:
+        if url.startswith(gateway):
+            path = url[len(gateway):]
+            return [g + path for g in IPFS_GATEWAYS]
+    return [url]
+
+def _get_metadata(url, timeout, session=IPFS_SESSION):
+    r = session.get(url, timeout=timeout)
+    r.raise_for_status()
+    if "application/json" in r.headers.get("Content-Type", "") or r.text.strip().startswith("{"):
+        return orjson.loads(r.content)
+    return None
+
 def fetch_metadata(uri: str):
-    try:
-        r = SESSION.get(uri, timeout=20)
-        if "application/json" in r.headers.get("Content-Type", "") or r.text.strip().startswith("{"):
-            return r.json()
-    except Exception as e:
-        print(f"Error fetching metadata from {uri}: {e}")
+    # Raises on network errors so callers can tell "not JSON" (None) from "not reachable"
+    urls = gateway_urls(uri)
+    if len(urls) == 1:
+        return _get_metadata(uri, 20)
+    # Race the gateways and keep the first JSON answer; losers finish in the background.
+    # A 200 that isn't JSON (an HTML error page, say) only loses: another gateway may still
+    # have the document, and a None result would be cached for META_TTL.
+    futures = [_GATEWAY_EXECUTOR.submit(_get_metadata, url, GATEWAY_TIMEOUT, GATEWAY_SESSION) for url in urls]
+    error = None
+    for future in as_completed(futures):
+        try:
+            meta = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+        if meta is None:
+            continue
+        for other in futures:
+            other.cancel()
+        return meta
+    if error:
+        raise error  # some gateway was unreachable; don't cache a miss it might have answered
     return None
 
-def fetch_image_bytes(url: str):
+IMAGE_SPOOL_BYTES = 1 << 20  # images larger than this spill from memory to a temp file
+
+def fetch_image(url: str):
+    # Stream into a spooled file so multi-MB images are never held in RAM as one bytes object
     try:
-        r = SESSION.get(url, timeout=25)
-        r.raise_for_status()
-        return r.content
+        with IPFS_SESSION.get(url, stream=True, timeout=25) as r:
+            r.raise_for_status()
+            f = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_BYTES)
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+        if not f.tell():
+            f.close()
+            return None
+        f.seek(0)
+        return f
     except Exception as e:
         print(f"Error fetching image from {url}: {e}")
         return None
 
+# Telegram allows roughly one message per second per chat; pace bursts locally instead of
+# discovering the limit through a 429 and its forced retry_after sleep.
+TELEGRAM_MIN_GAP = 1.05
+_LAST_SEND = 0.0
+_PACED_SENDS = 0
+_TELEGRAM_429S = 0
+_SEND_LOCK = threading.Lock()
+
+def _pace_telegram():
+    global _LAST_SEND, _PACED_SENDS
+    gap = time.monotonic() - _LAST_SEND
+    if gap < TELEGRAM_MIN_GAP:
+        _PACED_SENDS += 1
+        time.sleep(TELEGRAM_MIN_GAP - gap)
+    _LAST_SEND = time.monotonic()
+
+_PACED_REPORTED = 0
+
+def report_pacing():
+    """Once per cycle: how many sends were held back locally, i.e. 429s that never happened."""
+    global _PACED_REPORTED
+    if _PACED_SENDS != _PACED_REPORTED:
+        print(f"Telegram pacing: {_PACED_SENDS - _PACED_REPORTED} sends delayed locally this cycle "
+              f"({_PACED_SENDS} total, {_TELEGRAM_429S} 429s hit)")
+        _PACED_REPORTED = _PACED_SENDS
+
+# image_url -> Telegram file_id of a photo we already uploaded, so repeat images skip the round trips
+MAX_PHOTO_IDS = 1024
+_PHOTO_IDS = OrderedDict()
+_PHOTO_IDS_LOCK = threading.Lock()
+
+def cached_photo_id(image_url):
+    with _PHOTO_IDS_LOCK:
+        return _PHOTO_IDS.get(image_url)
+
+def forget_photo_id(image_url):
+    with _PHOTO_IDS_LOCK:
+        _PHOTO_IDS.pop(image_url, None)
+
+def remember_photo_id(image_url, resp):
+    try:
+        # PhotoSize entries run smallest to largest; keep the full-resolution one
+        file_id = orjson.loads(resp.content)["result"]["photo"][-1]["file_id"]
+    except Exception:
+        return
+    with _PHOTO_IDS_LOCK:
+        _PHOTO_IDS[image_url] = file_id
+        _PHOTO_IDS.move_to_end(image_url)
+        if len(_PHOTO_IDS) > MAX_PHOTO_IDS:
+            _PHOTO_IDS.popitem(last=False)
+
 def send_telegram(text: str, image_url: str | None = None):
-    def _post_json(endpoint, payload, files=None):
+    def _post_json(endpoint, payload, files=None, log_errors=True):
+        global _TELEGRAM_429S
         url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{endpoint}"
-        try:
-            if files:
-                resp = requests.post(url, data=payload, files=files, timeout=30)
-            else:
-                resp = requests.post(url, json=payload, timeout=30)
-            if resp.status_code == 429:
-                try:
-                    data = resp.json()
-                    ra = data.get("parameters", {}).get("retry_after", 10)
-                except Exception:
-                    ra = 10
-                print(f"Telegram 429: retrying after {ra}s")
-                time.sleep(int(ra) + 1)
+        # Both pollers send from their own threads; one request at a time keeps the per-chat pacing honest
+        with _SEND_LOCK:
+            try:
+                _pace_telegram()
                 if files:
-                    resp = requests.post(url, data=payload, files=files, timeout=30)
+                    resp = TELEGRAM_SESSION.post(url, data=payload, files=files, timeout=30)
                 else:
-                    resp = requests.post(url, json=payload, timeout=30)
-            if resp.status_code != 200:
-                print(f"Telegram API error: {resp.status_code} - {resp.text}")
-            return resp
-        except Exception as e:
-            print(f"Telegram send error: {e}")
+                    resp = TELEGRAM_SESSION.post(url, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=30)
+                if resp.status_code == 429:
+                    try:
+                        data = orjson.loads(resp.content)
+                        ra = int(data.get("parameters", {}).get("retry_after", 10))
+                    except Exception:
+                        ra = 10
+                    _TELEGRAM_429S += 1
+                    print(f"Telegram 429: retrying after {ra}s ({_TELEGRAM_429S} hit, {_PACED_SENDS} sends paced locally)")
+                    # Sleep under the lock: the limit is per chat, so the other poller has to wait too
+                    time.sleep(ra + 1)
+                    _pace_telegram()  # restart the local gap from the retried request
+                    if files:
+                        for _, fobj in files.values():
+                            fobj.seek(0)
+                        resp = TELEGRAM_SESSION.post(url, data=payload, files=files, timeout=30)
+                    else:
+                        resp = TELEGRAM_SESSION.post(url, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=30)
+                if resp.status_code != 200 and log_errors:
+                    print(f"Telegram API error: {resp.status_code} - {resp.text}")
+                return resp
+            except Exception as e:
+                print(f"Telegram send error: {e}")
 
     if image_url:
-        image_url = image_url.replace("#", "%23")
-        img = fetch_image_bytes(image_url)
-        if img:
-            files = {"photo": ("nft_image.jpg", img)}
-            payload = {"chat_id": TELEGRAM_CHAT_ID, "caption": text, "parse_mode": "HTML"}
-            _post_json("sendPhoto", payload, files=files)
+        caption = {"chat_id": TELEGRAM_CHAT_ID, "caption": text, "parse_mode": "HTML"}
+        file_id = cached_photo_id(image_url)
+        if file_id:
+            # Telegram already has this picture: reference it instead of fetching it again
+            resp = _post_json("sendPhoto", {**caption, "photo": file_id}, log_errors=False)
+            if resp is None:
+                return  # no answer after the request went out; it may have posted, so don't send again
+            if resp.status_code == 200:
+                return
+            forget_photo_id(image_url)
+
+        # Let Telegram fetch the URL server-side; the image never transits this process
+        resp = _post_json("sendPhoto", {**caption, "photo": image_url}, log_errors=False)
+        if resp is None:
+            # Timed out or dropped mid-request: Telegram may still be fetching the URL and post it,
+            # so an upload now could land as a second copy
+            print("sendPhoto by URL got no response; not re-sending.")
+            return
+        if resp.status_code == 200:
+            remember_photo_id(image_url, resp)
             return
+        print(f"Telegram API error: {resp.status_code} - {resp.text}")
+
+        # Telegram answered and refused (e.g. "failed to get HTTP URL content", wrong content type)
+        # or failed server-side: nothing was posted, so upload the bytes ourselves
+        image = fetch_image(image_url)
+        if image:
+            with image:
+                resp = _post_json("sendPhoto", caption, files={"photo": ("nft_image.jpg", image)})
+            if resp is None:
+                return  # the upload may have gone through; a text copy could duplicate it
+            if resp.status_code == 200:
+                remember_photo_id(image_url, resp)
+                return
+            print("Image upload failed; sending text only.")
         else:
             print("Image download failed; sending text only.")
 
@@ -184,188 +433,352 @@ def send_telegram(text: str, image_url: str | None = None):
 # ===============================
 # Core
 # ===============================
-def seed_seen_sales():
+_SALES_ETAG = STATE.get("sales_etag")
+_SALES_LM = STATE.get("sales_last_modified")
+# Set by the first successful sales response, even an empty one: an issuer with no sales yet
+# must still announce its first sale. State files from before the flag count as anchored
+# when they carry seen sales.
+_SALES_ANCHORED = bool(STATE.get("sales_anchored") or seen_sales)
+
+def fetch_sales():
+    """GET the lastSold list, revalidating with the previous validators; None means 304 Not Modified."""
+    global _SALES_ETAG, _SALES_LM
     params = {"list": "lastSold", "issuer": XRPL_NFT_ISSUER, "saleType": "all", "period": "all"}
+    headers = {}
+    if _SALES_ETAG:
+        headers["If-None-Match"] = _SALES_ETAG
+    if _SALES_LM:
+        headers["If-Modified-Since"] = _SALES_LM
+    r = SESSION.get(BITHOMP_SALES_URL, params=params, headers=headers, timeout=25)
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+    _SALES_ETAG = r.headers.get("ETag")
+    _SALES_LM = r.headers.get("Last-Modified")
+    return orjson.loads(r.content).get("sales", [])
+
+def normalize_image_url(raw: str) -> str:
+    """Gateway URL for ipfs:// links, with '#' escaped so Telegram and IPFS see the full path."""
+    if raw.startswith("ipfs://"):
+        raw = IPFS_GATEWAYS[0] + raw[7:]
+    return raw.replace("#", "%23") if "#" in raw else raw
+
+META_TTL = 3600  # seconds before a cached metadata document is fetched again
+
+@lru_cache(maxsize=2048)
+def _extract_meta(uri, _ttl_bucket=None):
+    # Only successful lookups are cached: lru_cache does not store results of calls that raise.
+    # _ttl_bucket changes every META_TTL seconds, so older entries stop matching and age out.
+    meta = fetch_metadata(uri)
+    if not meta:
+        return None, normalize_image_url(uri)
+    # Escape once here; the cached name is then ready for the HTML message on every repeat
+    name = meta.get("name")
+    safe_name = html.escape(str(name)) if name else None
+    img_link = meta.get("image") or meta.get("image_url") or meta.get("imageUrl")
+    return safe_name, normalize_image_url(img_link) if img_link else None
+
+def resolve_media(uri_hex):
+    """Return (HTML-escaped item name, image_url) for an on-ledger hex URI; either may be None."""
+    if not uri_hex:
+        return None, None
+    uri = decode_uri(uri_hex)
+    if not uri:
+        return None, None
     try:
-        r = SESSION.get(BITHOMP_SALES_URL, params=params, timeout=25)
-        r.raise_for_status()
-        sales = r.json().get("sales", [])
-        for s in sales:
-            txh = s.get("acceptedTxHash")
-            if txh:
-                remember_sale(txh)
-        persist_now()
-        print(f"Seeded seen_sales with {len(sales)} current sales. (No posts on seed)")
+        safe_name, image_url = _extract_meta(uri, int(time.monotonic() // META_TTL))
     except Exception as e:
-        print(f"Failed to seed seen sales: {e}")
+        print(f"Error fetching metadata from {uri}: {e}")
+        safe_name, image_url = None, normalize_image_url(uri)
+    return safe_name, image_url
+
+# Mirrored copy
+SALE_TMPL = (
+    "🚀 <b>!YUB TFN WEN</b>\n\n"
+    "🏷️ <b>METI:</b> <a href=\"{nft_link}\">{name}</a>\n"
+    "💰 <b>ROF DLOS:</b> {price}\n"
+    "🔄 <b>RELLES:</b> <a href=\"{seller_link}\">{seller}</a>\n"
+    "➡️ <b>REYUB:</b> <a href=\"{buyer_link}\">{buyer}</a>\n"
+    "⏱️ <b>EMIT NOITCASNART:</b> {ts}\n"
+    "📑 <b>DI NOITCASNART:</b> <a href=\"{tx_link}\">{tx}</a>"
+)
+
+# Mirrored mint copy (no price line)
+MINT_TMPL = (
+    "🚀 <b>!TNIM TFN WEN</b>\n\n"
+    "🖼️ <b>EMAN NOITCELLOC:</b> sraebyzzuF\n"
+    "🏷️ <b>METI:</b> <a href=\"{nft_link}\">{name}</a>\n"
+    "⏱️ <b>EMIT NOITCASNART:</b> {ts}\n"
+    "📑 <b>DI NOITCASNART:</b> <a href=\"{tx_link}\">{tx}</a>"
+)
+
+def prepare_sale(sale):
+    """Network-bound part of a sale notification (metadata lookup); runs on _EXECUTOR."""
+    tx_hash = sale.get("acceptedTxHash")
+    nft = sale.get("nftoken", {})
+    buyer = sale.get("buyer")
+    seller = sale.get("seller")
+
+    amount_str = sale.get("amount")
+    try:
+        drops = int(amount_str) if amount_str else 0
+    except (TypeError, ValueError):
+        drops = 0
+    # Exact integer math on drops (1 XRP = 1,000,000 drops); fractions round half up to 2 dp
+    if drops % 1_000_000 == 0:
+        price_str = f"{drops // 1_000_000} XRP"
+    else:
+        whole, cents = divmod((drops + 5_000) // 10_000, 100)
+        price_str = f"{whole}.{cents:02d} XRP"
+
+    accepted_at = sale.get("acceptedAt")
+    if accepted_at:
+        try:
+            utc_time = fmt_ts(int(accepted_at))
+        except Exception:
+            utc_time = "N/A"
+    else:
+        utc_time = "N/A"
+
+    safe_item_name, image_url = resolve_media(nft.get("uri"))
+    if not safe_item_name:
+        safe_item_name = abbr(nft.get("nftokenID"))  # hex id, nothing to escape
+
+    nft_id = nft.get("nftokenID")
+    fields = {
+        "nft_link": f"https://bithomp.com/en/nft/{nft_id}" if nft_id else "",
+        "name": safe_item_name,
+        "price": price_str,
+        "seller_link": f"https://xrpscan.com/account/{seller}" if seller else "",
+        "seller": abbr(seller),
+        "buyer_link": f"https://xrpscan.com/account/{buyer}" if buyer else "",
+        "buyer": abbr(buyer),
+        "ts": utc_time,
+        "tx_link": f"https://bithomp.com/explorer/{tx_hash}" if tx_hash else "",
+        "tx": abbr(tx_hash),
+    }
+    message = SALE_TMPL.format_map(fields)
+    log_line = f"Notified sale {tx_hash}: {price_str}, buyer {fields['buyer']}, seller {fields['seller']}"
+    return message, image_url, tx_hash, log_line
 
 def poll_sales():
-    params = {"list": "lastSold", "issuer": XRPL_NFT_ISSUER, "saleType": "all", "period": "all"}
+    global _SALES_ANCHORED
     try:
-        r = SESSION.get(BITHOMP_SALES_URL, params=params, timeout=25)
-        r.raise_for_status()
-        sales = r.json().get("sales", [])
+        sales = fetch_sales()
+        if sales is None:
+            return  # 304: nothing changed since the last poll
+
+        if not _SALES_ANCHORED:
+            # First poll without saved state: today's list is history, not news.
+            # Insert oldest-first so eviction order matches the incremental path.
+            for sale in reversed(sales):
+                tx_hash = sale.get("acceptedTxHash")
+                if tx_hash:
+                    remember_sale(tx_hash)
+            _SALES_ANCHORED = True
+            mark_state_dirty()
+            print(f"Anchored seen_sales on {len(sales)} current sales. (No posts on first poll)")
+            return
         if not sales:
             return
 
-        for sale in reversed(sales):
+        # Sales come newest-first: everything after the first already-seen hash is old
+        new_sales = deque()  # appendleft keeps it oldest-first without a reverse pass
+        for sale in sales:
             tx_hash = sale.get("acceptedTxHash")
             if not tx_hash:
                 continue
-            if tx_hash in seen_sales_set:
+            # The scan stops at the newest known hash; refreshing it keeps the stop point from
+            # being evicted while bithomp keeps returning it
+            if is_seen(seen_sales, tx_hash, refresh=True):
+                break
+            new_sales.appendleft(sale)
+        if not new_sales:
+            return  # steady state: the newest sale is already known
+
+        # Metadata lookups overlap; Telegram sends stay in chat order (oldest first)
+        for message, image_url, tx_hash, log_line in _EXECUTOR.map(prepare_sale, new_sales):
+            # Claim the hash before sending: a hash repeated within one batch is announced once
+            if not remember_sale(tx_hash):
                 continue
-
-            nft = sale.get("nftoken", {})
-            buyer = sale.get("buyer")
-            seller = sale.get("seller")
-
-            amount_str = sale.get("amount")
-            try:
-                amount_drops = int(amount_str) if amount_str else 0
-                price_xrp = amount_drops / 1_000_000
-            except Exception:
-                price_xrp = 0
-            price_str = f"{int(price_xrp)} XRP" if float(price_xrp).is_integer() else f"{price_xrp:.2f} XRP"
-
-            accepted_at = sale.get("acceptedAt")
-            if accepted_at:
-                try:
-                    tx_timestamp = int(accepted_at)
-                    utc_time = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(tx_timestamp))
-                except Exception:
-                    utc_time = "N/A"
-            else:
-                utc_time = "N/A"
-
-            item_name = None
-            image_url = None
-            uri_hex = nft.get("uri")
-            if uri_hex:
-                uri = decode_uri(uri_hex)
-                if uri:
-                    meta = fetch_metadata(uri)
-                    if meta:
-                        item_name = meta.get("name")
-                        img_link = meta.get("image") or meta.get("image_url") or meta.get("imageUrl")
-                        if img_link:
-                            image_url = f"https://ipfs.io/ipfs/{img_link[7:]}" if img_link.startswith("ipfs://") else img_link
-                    else:
-                        image_url = uri
-            if not item_name:
-                item_name = abbr(nft.get("nftokenID"))
-            safe_item_name = html.escape(item_name)
-
-            nft_id = nft.get("nftokenID")
-            nft_link = f"https://bithomp.com/en/nft/{nft_id}" if nft_id else ""
-            buyer_link = f"https://xrpscan.com/account/{buyer}" if buyer else ""
-            seller_link = f"https://xrpscan.com/account/{seller}" if seller else ""
-            tx_link = f"https://bithomp.com/explorer/{tx_hash}" if tx_hash else ""
-            buyer_abbr = abbr(buyer)
-            seller_abbr = abbr(seller)
-            tx_abbr = abbr(tx_hash)
-
-            if image_url and "#" in image_url:
-                image_url = image_url.replace("#", "%23")
-
-            # Mirrored copy
-            message = (
-                "🚀 <b>!YUB TFN WEN</b>\n\n"
-                f"🏷️ <b>METI:</b> <a href=\"{nft_link}\">{safe_item_name}</a>\n"
-                f"💰 <b>ROF DLOS:</b> {price_str}\n"
-                f"🔄 <b>RELLES:</b> <a href=\"{seller_link}\">{seller_abbr}</a>\n"
-                f"➡️ <b>REYUB:</b> <a href=\"{buyer_link}\">{buyer_abbr}</a>\n"
-                f"⏱️ <b>EMIT NOITCASNART:</b> {utc_time}\n"
-                f"📑 <b>DI NOITCASNART:</b> <a href=\"{tx_link}\">{tx_abbr}</a>"
-            )
             send_telegram(message, image_url=image_url)
-
-            remember_sale(tx_hash)
-            persist_now()
-            print(f"Notified sale {tx_hash}: {price_str}, buyer {buyer_abbr}, seller {seller_abbr}")
+            print(log_line)
 
     except Exception as e:
         print(f"Error processing sales: {e}")
+        raise
+
+def prepare_mint(tx_obj):
+    """Network-bound part of a mint notification (metadata lookup); runs on _EXECUTOR."""
+    tx_hash = tx_obj.get("hash")
+    timestamp = tx_obj.get("date")
+    utc_time = fmt_ts(timestamp + 946684800) if timestamp else "N/A"
+
+    nft_id = tx_obj.get("NFTokenID")
+    safe_item_name, image_url = resolve_media(tx_obj.get("URI"))
+    if not safe_item_name:
+        safe_item_name = "Unknown NFT"
+
+    fields = {
+        "nft_link": f"https://bithomp.com/en/nft/{nft_id}" if nft_id else "",
+        "name": safe_item_name,
+        "ts": utc_time,
+        "tx_link": f"https://bithomp.com/explorer/{tx_hash}" if tx_hash else "",
+        "tx": abbr(tx_hash),
+    }
+    message = MINT_TMPL.format_map(fields)
+    log_line = f"Notified mint {tx_hash}: item name: {safe_item_name}"
+    return message, image_url, tx_hash, log_line
+
+# First ledger poll_mints has not scanned yet; None until the first successful poll
+_MINT_LEDGER_CURSOR = STATE.get("mint_ledger_cursor")
 
 def poll_mints():
+    global _MINT_LEDGER_CURSOR
+    # Only ask for ledgers closed since the last poll, so steady-state responses carry just the new txs
     payload = {
         "method": "account_tx",
         "params": [{
             "account": XRPL_NFT_ISSUER,
-            "ledger_index_min": -1,
+            "ledger_index_min": _MINT_LEDGER_CURSOR if _MINT_LEDGER_CURSOR is not None else -1,
             "ledger_index_max": -1,
             "limit": 50,
-            "forward": False
+            "forward": False,
+            "binary": False,
+            # Clio servers filter by type server-side; rippled ignores the field,
+            # so the TransactionType check below stays as the authoritative filter
+            "tx_type": "nftokenmint",
         }]
     }
     try:
-        r = SESSION.post(XRPL_RPC_URL, json=payload, timeout=25)
+        r = RPC_SESSION.post(XRPL_RPC_URL, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=25)
         r.raise_for_status()
-        txs = r.json().get("result", {}).get("transactions", []) or []
-        if not txs:
+        result = orjson.loads(r.content).get("result", {})
+        if result.get("status") == "error":
+            # e.g. lgrIdxsInvalid when no ledger closed since the cursor; rescan the full range next time
+            print(f"account_tx error: {result.get('error')}")
+            _MINT_LEDGER_CURSOR = None
             return
+        txs = result.get("transactions", []) or []
 
-        for entry in reversed(txs):
+        # forward=False returns newest-first; stop at the first mint we already announced
+        new_mints = deque()
+        for entry in txs:
             tx_obj = entry.get("tx", {})
             if tx_obj.get("TransactionType") != "NFTokenMint":
                 continue
             tx_hash = tx_obj.get("hash")
-            if not tx_hash or tx_hash in seen_mints_set:
+            if not tx_hash:
                 continue
-
-            timestamp = tx_obj.get("date")
-            utc_time = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp + 946684800)) if timestamp else "N/A"
-
-            nft_id = tx_obj.get("NFTokenID")
-            uri_hex = tx_obj.get("URI")
-            item_name = None
-            image_url = None
-            if uri_hex:
-                uri = decode_uri(uri_hex)
-                if uri:
-                    meta = fetch_metadata(uri)
-                    if meta:
-                        item_name = meta.get("name")
-                        img_link = meta.get("image") or meta.get("image_url") or meta.get("imageUrl")
-                        if img_link:
-                            image_url = f"https://ipfs.io/ipfs/{img_link[7:]}" if img_link.startswith("ipfs://") else img_link
-                    else:
-                        image_url = uri
-            if not item_name:
-                item_name = "Unknown NFT"
-            safe_item_name = html.escape(item_name)
-
-            nft_link = f"https://bithomp.com/en/nft/{nft_id}" if nft_id else ""
-            tx_link  = f"https://bithomp.com/explorer/{tx_hash}" if tx_hash else ""
-            tx_abbr  = abbr(tx_hash)
-
-            if image_url and "#" in image_url:
-                image_url = image_url.replace("#", "%23")
-
-            # Mirrored mint copy (no price line)
-            message = (
-                "🚀 <b>!TNIM TFN WEN</b>\n\n"
-                "🖼️ <b>EMAN NOITCELLOC:</b> sraebyzzuF\n"
-                f"🏷️ <b>METI:</b> <a href=\"{nft_link}\">{safe_item_name}</a>\n"
-                f"⏱️ <b>EMIT NOITCASNART:</b> {utc_time}\n"
-                f"📑 <b>DI NOITCASNART:</b> <a href=\"{tx_link}\">{tx_abbr}</a>"
-            )
-            send_telegram(message, image_url=image_url)
-
-            remember_mint(tx_hash)
-            persist_now()
-            print(f"Notified mint {tx_hash}: item name: {safe_item_name}")
+            if is_seen(seen_mints, tx_hash, refresh=True):
+                break
+            new_mints.appendleft(tx_obj)
+
+        if new_mints:
+            for message, image_url, tx_hash, log_line in _EXECUTOR.map(prepare_mint, new_mints):
+                # Claim the hash before sending: a hash repeated within one batch is announced once
+                if not remember_mint(tx_hash):
+                    continue
+                send_telegram(message, image_url=image_url)
+                print(log_line)
+
+        ledger_max = result.get("ledger_index_max")
+        if isinstance(ledger_max, int):
+            _MINT_LEDGER_CURSOR = ledger_max + 1
 
     except Exception as e:
         print(f"Error polling mints: {e}")
+        raise
+
+def _backoff(failures):
+    """Seconds to wait after `failures` consecutive errors: exponential, capped at 60, jittered +/-50%."""
+    return min(60, (2 ** failures) * (0.5 + random.random()))
+
+# Per-poller consecutive failures and the monotonic time before which it is not retried
+_POLL_FAILURES = {}
+_POLL_RETRY_AT = {}
+
+def run_poller(poller):
+    """Run one poller unless it is backing off; a failing source never delays the other one."""
+    if time.monotonic() < _POLL_RETRY_AT.get(poller, 0.0):
+        return
+    try:
+        poller()
+    except Exception:
+        failures = _POLL_FAILURES.get(poller, 0) + 1
+        _POLL_FAILURES[poller] = failures
+        delay = _backoff(failures)
+        _POLL_RETRY_AT[poller] = time.monotonic() + delay
+        print(f"{poller.__name__} failed {failures}x in a row; next attempt in {delay:.1f}s")
+    else:
+        _POLL_FAILURES.pop(poller, None)
+        _POLL_RETRY_AT.pop(poller, None)
+
+# Set by watch_issuer() when a validated mint by the issuer is streamed; wakes the main loop early
+_MINT_ACTIVITY = threading.Event()
+
+def watch_issuer():
+    """Background thread: XRPL subscribe stream used as a doorbell for poll_mints.
+
+    The stream only signals; poll_mints still does the fetching, dedup and sending, so the timed
+    poll remains a complete fallback whenever the socket is down.
+    """
+    subscribe = orjson.dumps({"command": "subscribe", "accounts": [XRPL_NFT_ISSUER]}).decode()
+    failures = 0
+    while True:
+        ws = None
+        try:
+            ws = websocket.create_connection(XRPL_WS_URL, timeout=POLL_INTERVAL)
+            ws.send(subscribe)
+            failures = 0
+            while True:
+                try:
+                    msg = orjson.loads(ws.recv())
+                except websocket.WebSocketTimeoutException:
+                    ws.ping()  # idle issuer; keep the connection alive
+                    continue
+                tx = msg.get("transaction") or {}
+                if msg.get("type") == "transaction" and msg.get("validated") and tx.get("TransactionType") == "NFTokenMint":
+                    _MINT_ACTIVITY.set()
+        except Exception as e:
+            failures += 1
+            delay = _backoff(failures)
+            print(f"XRPL stream error: {e}; reconnecting in {delay:.1f}s")
+        finally:
+            if ws is not None:
+                ws.close()
+        time.sleep(delay)
 
 # ===============================
 # Boot
 # ===============================
-print("Starting NFT sales tracker (Telegram Bot #2)...")
-print(f"Tracking issuer: {XRPL_NFT_ISSUER}")
-seed_seen_sales()
-
-while True:
-    poll_sales()
-    poll_mints()
-    time.sleep(POLL_INTERVAL)
+def run():
+    # Flush pending state on normal exit and on SIGTERM (Railway stops containers with SIGTERM)
+    atexit.register(persist_now)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print("Starting NFT sales tracker (Telegram Bot #2)...")
+    print(f"Tracking issuer: {XRPL_NFT_ISSUER}")
+    # With no saved state the first poll_sales call anchors without posting
+    print(f"Restored {len(seen_sales)} seen sales and {len(seen_mints)} seen mints from state.")
+
+    if XRPL_WS_URL:
+        threading.Thread(target=watch_issuer, name="xrpl-stream", daemon=True).start()
+
+    next_sales = 0.0
+    while True:
+        # bithomp has no push feed, so sales stay on the timer; a streamed mint only re-polls mints
+        pollers = [poll_mints]
+        if time.monotonic() >= next_sales:
+            pollers.append(poll_sales)
+            next_sales = time.monotonic() + POLL_INTERVAL
+        # The cycle takes as long as the slower source instead of the sum of both
+        for f in [_POLLERS.submit(run_poller, p) for p in pollers]:
+            f.result()
+        report_pacing()
+        maybe_flush_state()
+        _MINT_ACTIVITY.wait(max(0.0, next_sales - time.monotonic()))
+        _MINT_ACTIVITY.clear()
+
+if __name__ == "__main__":
+    run()